@@ -7,12 +7,12 @@ EPUB ファイルの TOC を表示
 import argparse
 
 try:
-    from .epub_extractor import EpubExtractor
+    from .epub_extractor import EpubExtractor, map_epub_files
 except (ValueError, SystemError, ImportError):
     try:
-        from epub_extractor import EpubExtractor
+        from epub_extractor import EpubExtractor, map_epub_files
     except (ValueError, SystemError, ImportError):
-        from epub_extractor.epub_extractor import EpubExtractor
+        from epub_extractor.epub_extractor import EpubExtractor, map_epub_files
 
 
 def procedure(file_path):
@@ -35,9 +35,7 @@ def main():
     args = parser.parse_args()
 
     if len(args.epub_files) > 1:
-        out = []
-        for epub_file in args.epub_files:
-            out.append(procedure(epub_file))
+        out = map_epub_files(procedure, args.epub_files)
     else:
         out = procedure(args.epub_files[0])
 
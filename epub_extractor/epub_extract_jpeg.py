@@ -4,14 +4,15 @@ EPUB ファイルを jpeg に展開する
 """
 
 import argparse
+from functools import partial
 
 try:
-    from .epub_extractor import EpubExtractor
+    from .epub_extractor import EpubExtractor, map_epub_files
 except (ValueError, SystemError, ImportError):
     try:
-        from epub_extractor import EpubExtractor
+        from epub_extractor import EpubExtractor, map_epub_files
     except (ValueError, SystemError, ImportError):
-        from epub_extractor.epub_extractor import EpubExtractor
+        from epub_extractor.epub_extractor import EpubExtractor, map_epub_files
 
 
 def procedure(file_path, convert_png=True, delete_exists_dir=False):
@@ -48,12 +49,15 @@ def main():
 
     args = parser.parse_args()
 
-    for epub_file in args.epub_files:
-        procedure(
-            epub_file,
-            convert_png=not args.no_png_convert,
-            delete_exists_dir=args.delete_exists_dir,
-        )
+    function = partial(
+        procedure,
+        convert_png=not args.no_png_convert,
+        delete_exists_dir=args.delete_exists_dir,
+    )
+    if len(args.epub_files) > 1:
+        map_epub_files(function, args.epub_files)
+    else:
+        function(args.epub_files[0])
 
 
 if __name__ == '__main__':
@@ -1,53 +1,175 @@
 #!/usr/bin/env python3
 
+import codecs
+import io
 import os
+import posixpath
 import re
 import shutil
-import subprocess
 import sys
-import tempfile
+import threading
 import warnings
+import zipfile
 from abc import ABCMeta, abstractmethod
-from collections import OrderedDict
-from functools import cached_property
-from typing import Callable, Dict, Iterator, List, Optional
-from xml.etree import ElementTree
-from xml.etree.ElementTree import Element
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import cached_property, partial
+from itertools import count, groupby
+from operator import itemgetter
+from types import SimpleNamespace
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from lxml import etree as ElementTree
+from lxml.etree import _Element as Element
+
+# 画像の展開はスレッド並列で行うので、進捗の出力が混ざらないようにする
+print_lock = threading.Lock()
+
+# XML のパースオプション。parse も iterparse もこれを使う
+# 外部実体は展開しない
+XML_PARSE_OPTIONS = {
+    'huge_tree': True,
+    'resolve_entities': False,
+}  # type: Dict[str, Any]
+# 壊れた XML でも、読めるところまで読む
+RECOVER_XML_PARSE_OPTIONS = dict(XML_PARSE_OPTIONS, recover=True)
+# repair_xml_source で修復し、UTF-8 にした XML を読む
+REPAIRED_XML_PARSE_OPTIONS = dict(RECOVER_XML_PARSE_OPTIONS, encoding='utf-8')
+
+# パーサーは毎回作らずに使い回す
+# (lxml のパーサーは内部でロックを取るので、スレッドから使っても安全)
+xml_parser = ElementTree.XMLParser(**XML_PARSE_OPTIONS)
+repaired_xml_parser = ElementTree.XMLParser(**REPAIRED_XML_PARSE_OPTIONS)
+
+re_entity = re.compile(r'(>[^<]*)(&)([^<]*<)')
+re_replace = re.compile(r'&(?!#?\w+;)')
+re_xml_encoding = re.compile(rb'<\?xml[^>]*?encoding=["\']([\w.:-]+)["\']')
 
 
-def parse_xml_with_recover(xml_path: str) -> ElementTree:
+def xml_repair(xml_source: str) -> str:
     """
-    xmlをパース
+    XMLのソースコードの、テキスト部分の & を &amp; に変換する
+    CDATA やコメントの中の & はそのまま残す
+    """
+    if '&' not in xml_source:
+        # & 以外の理由で壊れている場合は、正規表現で走査しない
+        return xml_source
+
+    def _replace(matcher):
+        return re_replace.sub('&amp;', matcher.group(0))
+
+    return re_entity.sub(_replace, xml_source)
+
+
+def get_xml_encoding(xml_source: bytes) -> str:
+    """
+    XML のバイト列のエンコーディングを、BOM か XML 宣言から判定する
+    """
+    for bom, encoding in (
+        (codecs.BOM_UTF8, 'utf-8-sig'),
+        (codecs.BOM_UTF16_LE, 'utf-16'),
+        (codecs.BOM_UTF16_BE, 'utf-16'),
+    ):
+        if xml_source.startswith(bom):
+            return encoding
+    if xml_source.startswith(b'<\x00'):
+        return 'utf-16-le'
+    if xml_source.startswith(b'\x00<'):
+        return 'utf-16-be'
+    m = re_xml_encoding.match(xml_source)
+    if m:
+        encoding = m.group(1).decode('ascii')
+        try:
+            codecs.lookup(encoding)
+            return encoding
+        except LookupError:
+            pass
+    return 'utf-8'
+
+
+def repair_xml_source(xml_source: bytes) -> bytes:
+    """
+    パースできなかった XML のバイト列の & を修復し、UTF-8 のバイト列にする
+    UTF-16 の場合もあるので、バイト列のままではなく、デコードしてから置換する
+    """
+    text = xml_source.decode(get_xml_encoding(xml_source), errors='replace')
+    return xml_repair(text).encode('utf-8')
+
+
+def parse_xml_with_recover(xml_file: Union[str, IO[bytes]]) -> ElementTree:
+    """
+    xmlをパース (ファイルパスかファイルオブジェクト)
     & の使い方が悪いファイルがある場合、
-    それをパースしようとするとエラーになるので、失敗したら文字列置換してリトライする。
+    それをパースしようとするとエラーになるので、失敗したら & を修復して、
+    lxml の recover モードでパースし直す。
+    (recover モードだけだと、& は文字ごと捨てられてしまう)
     http://stackoverflow.com/questions/13046240/parseerror-not-well-formed
     -invalid-token-using-celementtree
-    ここには、lxml の場合の対応方法があるが、python3 のxml ではやり方不明のため
-    ( ElementTree.XMLParser のコンストラクタには recover 引数が無い)、
-    自力で置換する
     """
+    if isinstance(xml_file, str):
+        with open(xml_file, 'rb') as f:
+            xml_source = f.read()
+    else:
+        xml_source = xml_file.read()
     try:
-        etree = ElementTree.parse(xml_path)
-        return etree
-    except ElementTree.ParseError as e:
-        # ParseError の場合のみ、修復を試みる
-        print('{}, {}'.format(e.__class__.__name__, e))
+        return ElementTree.parse(io.BytesIO(xml_source), parser=xml_parser)
+    except ElementTree.XMLSyntaxError:
+        # XMLSyntaxError の場合のみ、修復を試みる
+        pass
+    return ElementTree.parse(
+        io.BytesIO(repair_xml_source(xml_source)), parser=repaired_xml_parser
+    )
+
+
+SVG_IMAGE_TAG = '{http://www.w3.org/2000/svg}image'
+XHTML_IMG_TAG = '{http://www.w3.org/1999/xhtml}img'
+XHTML_A_TAG = '{http://www.w3.org/1999/xhtml}a'
+# 画像要素で、画像のパスが入っている属性名 (優先順)
+IMAGE_PATH_ATTR_NAMES = (
+    '{http://www.w3.org/1999/xlink}href',
+    'src',
+    '{http://www.w3.org/1999/xlink}src',
+)
 
-    xml_source = open(xml_path).read()
-    # 修復!
-    xml_source = xml_repair(xml_source)
-    return ElementTree.fromstring(xml_source)
+
+def iter_image_attributes(
+    xml_file: Union[str, IO[bytes]], tag: str
+) -> Iterator[Dict[str, str]]:
+    """
+    xml_file 内の tag 要素の属性を、出現順に返すジェネレータ
+    iterparse で読み進め、読み終わった要素は都度解放するので、
+    ページ全体のツリーをメモリに保持しない
+    """
+    for _event, element in ElementTree.iterparse(
+        xml_file, tag=tag, **RECOVER_XML_PARSE_OPTIONS
+    ):
+        yield dict(element.attrib)
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
 
 
 def convert_to_jpeg(
-    source_file_path: str,
+    source_file: Union[str, IO[bytes]],
     destination_file_path: str,
     *,
     jpeg_quality: int = 70,
+    # copy: 元ファイルを消すかどうかの指定だった。
+    # 現在は ZIP から直接読むので、効果は無い。
     copy: bool = True,
 ) -> None:
     """
     PNG を Jpeg に変換する
+    source_file はファイルパスかファイルオブジェクト
     """
     try:
         from PIL import Image
@@ -61,53 +183,92 @@ def convert_to_jpeg(
         )
         raise
 
-    im = Image.open(source_file_path)
-    im = im.convert("RGB")
-    im.save(destination_file_path, 'jpeg', quality=jpeg_quality)
-    if not copy:
-        os.remove(source_file_path)
-    print('{} -> {}'.format(source_file_path, destination_file_path))
+    # ファイルパスを渡された場合も、すぐに閉じるよう with を使う
+    with Image.open(source_file) as im:
+        # JPEG にそのまま保存できるモード (グレースケールのコミックに多い L 等) なら
+        # 変換で画像をもう1枚作らない
+        if im.mode not in ('RGB', 'L'):
+            im = im.convert("RGB")
+        im.save(destination_file_path, 'jpeg', quality=jpeg_quality)
+    # ZIP のメンバー等のファイルオブジェクトは name にパスを持っている
+    source_name = getattr(source_file, 'name', source_file)
+    with print_lock:
+        print('{} -> {}'.format(source_name, destination_file_path))
 
 
-re_entity = re.compile(r'(>[^<]*)(&)([^<]*<)')
-re_replace = re.compile(r'&(?!\w*?;)')
+def get_etree_namespace(element: Element) -> str:
+    # タグ名 '{namespace}tag' の先頭を切り出す (正規表現も QName も使わない)
+    tag = element.tag
+    if tag[:1] == '{':
+        return tag[: tag.index('}') + 1]
+    return ''
 
 
-def xml_repair(xml_source: str) -> str:
+def get_epub_workers() -> Optional[int]:
     """
-    XMLのソースコードの & を &amp; に変換する
-    :param self:
-    :param xml_source:
-    :return:
+    環境変数 EPUB_WORKERS から並列数を取得する
+    未指定や、正の整数でない値の場合は None (CPU 数) にする
     """
-
-    def _replace(matcher):
-        return re_replace.sub('&amp;', matcher.group(0))
-
-    return re_entity.sub(_replace, xml_source)
-
-
-def get_etree_namespace(element: Element) -> str:
-    m = re.match('\{.*\}', element.tag)
-    return m.group(0) if m else ''
+    value = os.environ.get('EPUB_WORKERS', '').strip()
+    if not value:
+        return None
+    try:
+        workers = int(value)
+    except ValueError:
+        workers = 0
+    if workers < 1:
+        warnings.warn(
+            'EPUB_WORKERS must be a positive integer: {!r}'.format(value),
+            stacklevel=2,
+        )
+        return None
+    return workers
 
 
-def namespace_tag_query(element: Element) -> Callable[[str], str]:
+def map_epub_files(
+    function: Callable[[str], Any], epub_files: List[str]
+) -> List[Any]:
     """
-    element のネームスペースをバインドし、ネームスペースつきのタグ名を返す関数を返す
+    複数の EPUB ファイルをプロセス並列で処理し、結果を epub_files の順で返す
+    並列数は環境変数 EPUB_WORKERS で指定できる (デフォルトは CPU 数)
     """
-    ns = get_etree_namespace(element)
+    with ProcessPoolExecutor(max_workers=get_epub_workers()) as executor:
+        return list(executor.map(function, epub_files))
 
-    def _generate_query(tag_name):
-        return './/{}{}'.format(ns, tag_name)
 
-    return _generate_query
+def clean_toc_data(
+    toc_data: List[Dict[str, Any]], last_page_number: int
+) -> List[Dict[str, Any]]:
+    """
+    目次データを開始ページ順に並べ、同じ開始ページのものは最初の1件だけ残し、
+    end_page (次の目次の開始ページの前のページ) を付ける
+    """
+    entries = [o for o in toc_data if o['start_page'] is not None]
+    entries.sort(key=itemgetter('start_page'))
+    # ソート済みなので、同じ開始ページのものは隣り合っている
+    navs = [
+        next(group)
+        for _start_page, group in groupby(
+            entries, key=itemgetter('start_page')
+        )
+    ]
+    for nav, next_nav in zip(navs, navs[1:]):
+        nav['end_page'] = next_nav['start_page'] - 1
+    if navs:
+        navs[-1]['end_page'] = last_page_number
+    return navs
 
 
 class ImageElementBase(metaclass=ABCMeta):
     class ItemHrefNotFound(Exception):
         pass
 
+    item_element: Element
+
+    @cached_property
+    def item_href(self) -> Optional[str]:
+        return self.item_element.attrib.get('href', None)
+
     @cached_property
     @abstractmethod
     def image_path(self) -> str:
@@ -140,13 +301,14 @@ class ImageElement(ImageElementBase):
         item_href = self.item_element.attrib.get('href', None)
         if not item_href:
             raise self.ItemHrefNotFound(f'{self.item_element}')
-        return os.path.join(self.epub_extractor.content_base_dir, item_href)
+        return self.epub_extractor.get_content_path(item_href)
 
     @cached_property
     def is_png(self) -> bool:
-        return self.item_element.attrib.get('href', '').endswith(
-            '.png'
-        ) or self.item_element.attrib.get('media-type', '').endswith('/png')
+        attrib = self.item_element.attrib
+        href = attrib.get('href') or ''
+        media_type = attrib.get('media-type') or ''
+        return href.endswith('.png') or media_type.endswith('/png')
 
 
 class ImagePage(ImageElementBase):
@@ -183,37 +345,37 @@ class ImagePage(ImageElementBase):
         if not item_href:
             raise self.ItemHrefNotFound(self.item_element)
 
-        return os.path.join(self.epub_extractor.content_base_dir, item_href)
+        return self.epub_extractor.get_content_path(item_href)
 
-    # page_xml_path = os.path.join(self.content_base_dir, item_href)
+    def _find_image_attributes(
+        self, xml_path: str, tag: str
+    ) -> List[Dict[str, str]]:
+        with self.epub_extractor.zip_file.open(xml_path) as f:
+            return list(iter_image_attributes(f, tag))
 
     @cached_property
-    def page_xhtml_etree(self) -> ElementTree:
-        # ページを解析
-        return parse_xml_with_recover(self.page_xhtml_path)
-
-    @cached_property
-    def image_element(self) -> Element:
-
+    def image_element(self) -> Dict[str, str]:
+        """
+        ページ内の画像要素の属性
+        ページ全体のツリーは保持せず、画像要素の属性だけを残す
+        """
         if self.item_element.attrib.get('properties') == 'svg':
             # SVGラッピング 日本のコミックEPUBでよくある形式
-            svg = self.page_xhtml_etree.find(
-                './/{http://www.w3.org/2000/svg}svg'
+            # 画像パスの属性は {http://www.w3.org/1999/xlink}href
+            images = self._find_image_attributes(
+                self.page_xhtml_path, SVG_IMAGE_TAG
             )
-            if not svg:
+            if not images:
                 # 極稀に、svg タグが存在していない場合がある。
                 # 代わりに img タグを探す
-                images = self.page_xhtml_etree.findall(
-                    './/{http://www.w3.org/1999/xhtml}img'
+                images = self._find_image_attributes(
+                    self.page_xhtml_path, XHTML_IMG_TAG
                 )
-            else:
-                images = svg.findall('.//{http://www.w3.org/2000/svg}image')
-                # 画像パスの属性は {http://www.w3.org/1999/xlink}href
 
         else:
             # ここ未テスト
-            images = self.page_xhtml_etree.findall(
-                './/{http://www.w3.org/1999/xhtml}img'
+            images = self._find_image_attributes(
+                self.page_xhtml_path, XHTML_IMG_TAG
             )
             # 画像パスの属性は src
 
@@ -235,48 +397,45 @@ class ImagePage(ImageElementBase):
         """
         return self.get_image_path_of_image_element(self.image_element)
 
-    def get_largest_image_element(self, image_elements: List[Element]):
+    def get_largest_image_element(
+        self, image_elements: List[Dict[str, str]]
+    ) -> Dict[str, str]:
         """
         複数の image_element から一番サイズの大きな画像を取得
         """
-        L = [
-            (i, self.get_image_size_of_image_element(i))
-            for i in image_elements
-        ]
-        return list(sorted(L, key=lambda x: x[1], reverse=True))[0][0]
+        return max(image_elements, key=self.get_image_size_of_image_element)
 
     # その他プロパティが必要であれば
-    # self.image_element.attrib.get('width', None)
-    # self.image_element.attrib.get('height', None)
-    # self.image_element.attrib.get('width', None)
-    def get_image_path_of_image_element(self, image_element: Element) -> str:
-        attr_names = [
-            '{http://www.w3.org/1999/xlink}href',
-            'src',
-            '{http://www.w3.org/1999/xlink}src',
-        ]
-        for attr_name in attr_names:
-            val = image_element.attrib.get(attr_name)
+    # self.image_element.get('width', None)
+    # self.image_element.get('height', None)
+    # self.image_element.get('width', None)
+    def get_image_path_of_image_element(
+        self, image_element: Dict[str, str]
+    ) -> str:
+        for attr_name in IMAGE_PATH_ATTR_NAMES:
+            val = image_element.get(attr_name)
             if val:
-                return os.path.join(os.path.dirname(self.page_xhtml_path), val)
-        raise self.ImagePathAttrNotFound(image_element.attrib)
+                return posixpath.normpath(
+                    posixpath.join(
+                        posixpath.dirname(self.page_xhtml_path), val
+                    )
+                )
+        raise self.ImagePathAttrNotFound(image_element)
 
-    def get_image_size_of_image_element(self, image_element: Element) -> int:
+    def get_image_size_of_image_element(
+        self, image_element: Dict[str, str]
+    ) -> int:
         """
         画像のサイズを取得
         """
-        return os.path.getsize(
+        return self.epub_extractor.zip_file.getinfo(
             self.get_image_path_of_image_element(image_element)
-        )
+        ).file_size
 
     @cached_property
     def is_png(self) -> bool:
         return self.image_path.endswith('.png')
 
-    @cached_property
-    def item_href(self) -> Optional[str]:
-        return self.item_element.attrib.get('href', None)
-
 
 class ImageSVGElement(ImagePage):
     """
@@ -290,16 +449,11 @@ class ImageSVGElement(ImagePage):
             raise self.ItemHrefNotFound(f'{self.item_element}')
         if not item_href.lower().endswith('.svg'):
             # SVG ではない画像。普通の画像として扱う。
-            return os.path.join(
-                self.epub_extractor.content_base_dir, item_href
-            )
+            return self.epub_extractor.get_content_path(item_href)
         # SVG だった。
-        svg_path = os.path.join(
-            self.epub_extractor.content_base_dir, item_href
-        )
-        etree = parse_xml_with_recover(svg_path)
+        svg_path = self.epub_extractor.get_content_path(item_href)
         # SVG から image を抽出
-        images = etree.findall('.//{http://www.w3.org/2000/svg}image')
+        images = self._find_image_attributes(svg_path, SVG_IMAGE_TAG)
 
         if len(images) >= 2:
             return self.get_largest_image_element(images)
@@ -349,82 +503,144 @@ class EpubExtractor:
         self.setup()
 
     def setup(self) -> None:
-        self.temp_dir = tempfile.mkdtemp(suffix='epub-dump-meta')
-        # unzip
-        subprocess.Popen(
-            ('unzip', self.epub_file_path, "-d", self.temp_dir),
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        ).communicate()
+        # 展開はせず、必要なファイルだけを ZIP から直接読む
+        self.zip_file = zipfile.ZipFile(self.epub_file_path)
 
     def close(self, *, fail_silently=True) -> None:
-        try:
-            shutil.rmtree(self.temp_dir)
-        except PermissionError as e:
-            if not fail_silently:
-                raise
-            print('{}: {} ({})'.format(e.__class__.__name__, e, self.temp_dir))
+        # fail_silently は一時ディレクトリに展開していた頃の互換のために残している
+        self.zip_file.close()
+
+    def parse_xml(self, path: str) -> ElementTree:
+        """
+        EPUB 内の XML ファイルをパース
+        """
+        with self.zip_file.open(path) as f:
+            return parse_xml_with_recover(f)
+
+    def read_xml(self, path: str, reader: Callable[..., Any]) -> Any:
+        """
+        EPUB 内の XML ファイルを reader(ファイルオブジェクト, **パースオプション) で読む
+        ZIP から直接読み、XML が壊れていた場合だけ、
+        & を修復してから recover モードで読み直す
+        """
+        with self.zip_file.open(path) as f:
+            try:
+                return reader(f, **XML_PARSE_OPTIONS)
+            except ElementTree.XMLSyntaxError:
+                pass
+        return reader(
+            io.BytesIO(repair_xml_source(self.zip_file.read(path))),
+            **REPAIRED_XML_PARSE_OPTIONS,
+        )
+
+    def get_content_path(self, href: str) -> str:
+        """
+        content.xml (standard.opf) からの相対パスを、EPUB 内のパスにする
+        """
+        return posixpath.normpath(posixpath.join(self.content_base_dir, href))
 
     @cached_property
     def content_xml_path(self) -> str:
         """
-        content.xml (standard.opf) のファイルパスを返す
+        content.xml (standard.opf) の EPUB 内のパスを返す
         """
         # META-INF/container.xml で固定
-        container_xml_path = os.path.join(
-            self.temp_dir, 'META-INF', 'container.xml'
-        )
-        etree = parse_xml_with_recover(container_xml_path)
+        etree = self.parse_xml('META-INF/container.xml')
         # rootfile タグを探す
         rootfile_node = etree.find(
             ".//{urn:oasis:names:tc:opendocument:xmlns:container}rootfile"
         )
-        content_opf_path = rootfile_node.attrib['full-path']
+        content_xml_path = rootfile_node.attrib['full-path']
 
-        content_xml_path = os.path.join(self.temp_dir, content_opf_path)
-        if not os.path.exists(content_xml_path):
+        try:
+            self.zip_file.getinfo(content_xml_path)
+        except KeyError:
             raise self.ContentXmlNotFound(content_xml_path)
         return content_xml_path
 
-    @cached_property
+    @property
     def content_xml_text(self) -> str:
-        return open(self.content_xml_path).read()
+        # 再度読み込まず、パース済みのツリーから文字列にする
+        return ElementTree.tostring(
+            self.content_xml_etree.getroot(), encoding='unicode'
+        )
 
     @cached_property
     def content_xml_etree(self) -> ElementTree:
-        return parse_xml_with_recover(self.content_xml_path)
+        return self.parse_xml(self.content_xml_path)
 
     @cached_property
     def content_base_dir(self) -> str:
         # ファイルのパス基準となるディレクトリ
-        return os.path.dirname(self.content_xml_path)
+        return posixpath.dirname(self.content_xml_path)
+
+    @cached_property
+    def content_xml_elements(self) -> SimpleNamespace:
+        """
+        content.xml (standard.opf) を1回だけ走査して集めた要素
+        items_dict: id をキーにした item の辞書
+        itemrefs: spine > itemref のページ順のリスト
+        metadata_element: metadata エレメント
+        nav_item: ナビゲーション XML の item
+        ncx_item: toc.ncx の item
+        """
+        # '{namespace}' か ''
+        ns = get_etree_namespace(self.content_xml_etree.getroot())
+        item_tag = ns + 'item'
+        itemref_tag = ns + 'itemref'
+        metadata_tag = ns + 'metadata'
+
+        elements = SimpleNamespace(
+            items_dict={},
+            itemrefs=[],
+            metadata_element=None,
+            nav_item=None,
+            ncx_item=None,
+        )
+        for element in self.content_xml_etree.getroot().iter(
+            item_tag, itemref_tag, metadata_tag
+        ):
+            tag = element.tag
+            attrib = element.attrib
+            if tag == item_tag:
+                item_id = attrib.get('id')
+                if item_id is not None:
+                    # id の無い item は itemref から参照できないので入れない
+                    elements.items_dict[item_id] = element
+                if elements.nav_item is None and (
+                    item_id == 'toc' or attrib.get('properties') == 'nav'
+                ):
+                    elements.nav_item = element
+                if elements.ncx_item is None and (
+                    attrib.get('media-type') == 'application/x-dtbncx+xml'
+                    or item_id == 'ncx'
+                ):
+                    elements.ncx_item = element
+            elif tag == itemref_tag:
+                elements.itemrefs.append(element)
+            elif elements.metadata_element is None:
+                elements.metadata_element = element
+        return elements
 
     @cached_property
     def items_dict(self) -> Dict[str, Element]:
         """
         id をキーにした item の辞書
         """
-        ntq = namespace_tag_query(self.content_xml_etree._root)
-        manifest = self.content_xml_etree.find(ntq('manifest'))
-        items = manifest.findall(ntq('item'))
-        items_dict = {}  # type: Dict[str, Element]
-        for item in items:
-            id = item.attrib.get('id')
-            items_dict[id] = item
-        return items_dict
+        return self.content_xml_elements.items_dict
 
     @cached_property
-    def itemrefs(self) -> Iterator[Element]:
+    def itemrefs(self) -> List[Element]:
         """
-        spine > itemref をページ順に返すジェネレータ
+        spine > itemref のページ順のリスト
+        (ジェネレータだと、キャッシュされた後に2回目以降が空になる)
         """
-        ntq = namespace_tag_query(self.content_xml_etree._root)
-        spine = self.content_xml_etree.find(ntq('spine'))
-        itemrefs = spine.findall(ntq('itemref'))
-        for itemref in itemrefs:
-            yield itemref
+        return self.content_xml_elements.itemrefs
 
-    def _get_image_pages(self) -> Iterator[ImageElementBase]:
+    def _iter_spine_items(self) -> Iterator[Tuple[Element, Element]]:
+        """
+        spine > itemref と、対応する manifest > item をページ順に返すジェネレータ
+        """
         items_dict = self.items_dict
 
         for itemref in self.itemrefs:  # type: Element
@@ -436,8 +652,10 @@ class EpubExtractor:
             if idref not in items_dict:
                 raise self.ItemNotFound(idref)
 
-            item = items_dict[idref]  # type: Element
+            yield itemref, items_dict[idref]
 
+    def _get_image_pages(self) -> Iterator[ImageElementBase]:
+        for itemref, item in self._iter_spine_items():
             media_type = item.attrib.get('media-type', '')
             if media_type.startswith('image/svg'):
                 # image/svg+xml 等
@@ -454,8 +672,8 @@ class EpubExtractor:
     def image_pages(self) -> List[ImageElementBase]:
         return list(self._get_image_pages())
 
-    def format_page_number(self, page_number: str) -> str:
-        return '{:05d}'.format(page_number)
+    def format_page_number(self, page_number: int) -> str:
+        return f'{page_number:05d}'
 
     def _move_jpeg_file(
         self,
@@ -463,10 +681,8 @@ class EpubExtractor:
         output_dir: str,
         page_index: int,
         convert_png: bool = True,
-        # copy: 指定すると、ファイルの移動ではなくコピーをする。
-        # 1つの画像ファイルが複数箇所で使われれている場合、移動するとエラーになるので
-        # コピーをしたほうが安全に処理ができる。
-        # ただし、ストレージ容量が余分に必要で、遅い。
+        # copy: 一時ディレクトリに展開していた頃の、移動かコピーかの指定。
+        # 現在は ZIP から直接書き出すので、効果は無い。
         copy: bool = True,
     ):
         source_image_path = image_page.image_path
@@ -480,9 +696,8 @@ class EpubExtractor:
                 destination_image_path = os.path.join(
                     output_dir, destination_image_name
                 )
-                convert_to_jpeg(
-                    source_image_path, destination_image_path, copy=copy
-                )
+                with self.zip_file.open(source_image_path) as f:
+                    convert_to_jpeg(f, destination_image_path)
                 return
             destination_image_name = '{}.png'.format(
                 self.format_page_number(page_index)
@@ -494,22 +709,24 @@ class EpubExtractor:
         destination_image_path = os.path.join(
             output_dir, destination_image_name
         )
-        if copy:
-            shutil.copy(source_image_path, destination_image_path)
-        else:
-            shutil.move(source_image_path, destination_image_path)
-        print('{} -> {}'.format(source_image_path, destination_image_name))
+        with self.zip_file.open(source_image_path) as src, open(
+            destination_image_path, 'wb'
+        ) as dst:
+            shutil.copyfileobj(src, dst)
+        with print_lock:
+            print('{} -> {}'.format(source_image_path, destination_image_name))
 
     def extract_images(
         self,
         output_dir: Optional[str] = None,
         convert_png: bool = True,
         delete_exists_dir: bool = False,
+        # copy: 互換のために残している。効果は無い。
         copy: bool = True,
         fail_silently: bool = True,
     ):
         """
-        画像ファイルをディレクトリに展開(移動)
+        画像ファイルをディレクトリに展開
         """
         if not output_dir:
             output_dir, _ext = os.path.splitext(self.epub_file_path)
@@ -530,83 +747,113 @@ class EpubExtractor:
 
         os.mkdir(output_dir)
 
-        for i, image_page in enumerate(self.image_pages, start=1):
-            try:
-                self._move_jpeg_file(
-                    image_page,
-                    output_dir,
-                    i,
-                    convert_png=convert_png,
-                    copy=copy,
-                )
-            except ImagePage.InvalidImageLength as e:
-                warnings.warn(
-                    '{} {}'.format(e.__class__.__name__, e), stacklevel=2
-                )
+        # PNG の変換やファイルのコピーは GIL を解放するので、スレッドで並列化する
+        extract = partial(
+            self._extract_image_page,
+            output_dir=output_dir,
+            convert_png=convert_png,
+        )
+        with ThreadPoolExecutor(
+            max_workers=min(8, os.cpu_count() or 1)
+        ) as executor:
+            # image_pages のリストは作らず、ジェネレータから順に投入する
+            # 例外を呼び出し元に伝えるため、結果を取り出す
+            list(
+                executor.map(extract, self._get_image_pages(), count(start=1))
+            )
+
+    def _extract_image_page(
+        self,
+        image_page: ImageElementBase,
+        page_index: int,
+        *,
+        output_dir: str,
+        convert_png: bool,
+    ) -> None:
+        try:
+            self._move_jpeg_file(
+                image_page,
+                output_dir,
+                page_index,
+                convert_png=convert_png,
+            )
+        except ImagePage.InvalidImageLength as e:
+            warnings.warn(
+                '{} {}'.format(e.__class__.__name__, e), stacklevel=2
+            )
 
     @cached_property
     def metadata_element(self):
         """
         コンテンツXML ( standard.opf) 内の、metadata エレメント
         """
-        ntq = namespace_tag_query(self.content_xml_etree._root)
-        metadata = self.content_xml_etree.find(ntq('metadata'))
-        return metadata
+        return self.content_xml_elements.metadata_element
 
     @cached_property
     def last_page_number(self) -> int:
-        return len(self.image_pages)
+        # ページの XHTML を開く必要は無いので、spine の数を数える
+        return len(self.itemrefs)
 
     def _get_item_href_from_image_page(self, image_page):
         """
         ページのリンク先を取得
         e.g.: 'xhtml/cover.xhtml'
         """
-        path = getattr(image_page, 'item_href', None)
+        path = image_page.item_href
         if path:
             return path
-        if hasattr(image_page, 'item_element') and hasattr(
-            image_page.item_element, 'attrib'
-        ):
-            path = image_page.item_element.attrib.get('href', None)
-            if path:
-                return path
         # 未知のパターン。デバッグして調査してください。
         raise self.ItemHrefNotFound(image_page)
 
     @cached_property
-    def xml_path_page_number_dict(self) -> Dict[str, Element]:
+    def _page_number_dicts(self) -> Tuple[Dict[str, int], Dict[str, int]]:
+        """
+        (href とページ番号の対応表, ファイル名とページ番号の対応表)
+        ページごとの XHTML は開かず (item_href は manifest の属性)、
+        ページを1回走査して両方作る
+        """
+        href_page_index_dict = {}  # type: Dict[str, int]
+        basename_page_index_dict = {}  # type: Dict[str, int]
+        for i, image_page in enumerate(self._get_image_pages(), start=1):
+            href = self._get_item_href_from_image_page(image_page)
+            href_page_index_dict[href] = i
+            basename_page_index_dict[os.path.basename(href)] = i
+        return href_page_index_dict, basename_page_index_dict
+
+    @cached_property
+    def href_page_index_dict(self) -> Dict[str, int]:
+        """
+        item の href とページ番号の対応表
+        """
+        return self._page_number_dicts[0]
+
+    @cached_property
+    def xml_path_page_number_dict(self) -> Dict[str, int]:
         """
         XMLファイルとページ番号の対応表
         :return: dict
         """
-        return {
-            self._get_item_href_from_image_page(image_page): i
-            for i, image_page in enumerate(self.image_pages, start=1)
-        }
+        return self.href_page_index_dict
 
     @cached_property
-    def xml_path_page_number_dict_basename(self):
+    def xml_path_page_number_dict_basename(self) -> Dict[str, int]:
         """
         XMLファイルとページ番号の対応表 ファイル名のみ版
         :return: dict
         """
-        return {
-            os.path.basename(k): v
-            for k, v in self.xml_path_page_number_dict.items()
-        }
+        return self._page_number_dicts[1]
 
     def get_page_number_from_page_xml_path(self, page_xml_path, default=1):
         """
         ページXMLパスから画像番号を取得
         page_xml_path は XHTMLファイルのパスか、画像のパスになる(EPUB形式による)
         """
-        if page_xml_path in self.xml_path_page_number_dict:
-            return self.xml_path_page_number_dict[page_xml_path]
-        else:
-            return self.xml_path_page_number_dict_basename.get(
-                os.path.basename(page_xml_path), default
-            )
+        page_number = self.xml_path_page_number_dict.get(page_xml_path)
+        if page_number is not None:
+            return page_number
+        return self.xml_path_page_number_dict_basename.get(
+            os.path.basename(page_xml_path), default
+        )
 
     @cached_property
     def navigation_xml(self):
@@ -649,9 +896,27 @@ class EpubExtractor:
 
     @staticmethod
     def print_json(object):
-        import json
+        try:
+            # orjson があれば使う (速い)
+            import orjson
+        except ImportError:
+            import json
 
-        print(json.dumps(object, ensure_ascii=False, indent=2))
+            print(
+                json.dumps(object, ensure_ascii=False, indent=2, default=str)
+            )
+            return
+
+        data = orjson.dumps(object, default=str, option=orjson.OPT_INDENT_2)
+        buffer = getattr(sys.stdout, 'buffer', None)
+        if buffer is None:
+            # StringIO 等、テキストしか書けない stdout に差し替えられている場合
+            sys.stdout.write(data.decode() + '\n')
+            return
+        # orjson は UTF-8 の bytes を返すので、デコードせずにそのまま書き出す
+        sys.stdout.flush()
+        buffer.write(data + b'\n')
+        buffer.flush()
 
     def dump_meta(self):
         pass
@@ -706,16 +971,15 @@ class EpubMeta:
         return self._get_texts_dc('creator')
 
     def as_ordered_dict(self):
-        return OrderedDict(
-            [
-                ('title', self.title),
-                ('publisher', self.publisher),
-                ('identifier', self.identifier),
-                ('language', self.language),
-                ('creators', self.creators),
-                ('meta', self.meta_dict),
-            ]
-        )
+        # dict は挿入順を保持するので、OrderedDict は使わない
+        return {
+            'title': self.title,
+            'publisher': self.publisher,
+            'identifier': self.identifier,
+            'language': self.language,
+            'creators': self.creators,
+            'meta': self.meta_dict,
+        }
 
     def meta_tags(self):
         return self.meta_element.findall(
@@ -724,7 +988,7 @@ class EpubMeta:
 
     @cached_property
     def meta_dict(self):
-        od = OrderedDict()
+        od = {}
         for mt in self.meta_tags():
             if mt.attrib.get('refines'):
                 # refines 今回は無視
@@ -740,7 +1004,7 @@ class EpubMeta:
 
 class NavigationXml:
     """
-    NAVIGATION XML (Required BeautifulSoup4)
+    NAVIGATION XML
     """
 
     class NavigationXmlNotFound(EpubExtractorError):
@@ -751,62 +1015,48 @@ class NavigationXml:
 
     @cached_property
     def navigation_xml_path(self):
-        ntq = namespace_tag_query(self.ee.content_xml_etree._root)
-        manifest = self.ee.content_xml_etree.find(ntq('manifest'))
-        items = manifest.findall(ntq('item'))
-        for item in items:
-            if (
-                item.attrib.get('id') == 'toc'
-                or item.attrib.get('properties') == 'nav'
-            ):
-                return os.path.join(
-                    self.ee.content_base_dir, item.attrib.get('href')
-                )
-        raise self.NavigationXmlNotFound()
-
-    @cached_property
-    def navigation_xml_etree(self):
-        return parse_xml_with_recover(self.navigation_xml_path)
-
-    @cached_property
-    def navigation_xml_bs4(self):
-        from bs4 import BeautifulSoup
-
-        return BeautifulSoup(open(self.navigation_xml_path), "html.parser")
+        item = self.ee.content_xml_elements.nav_item
+        if item is None:
+            raise self.NavigationXmlNotFound()
+        return self.ee.get_content_path(item.attrib.get('href'))
+
+    def _read_anchors(
+        self, xml_file: IO[bytes], **options
+    ) -> List[Tuple[Optional[str], str]]:
+        """
+        a タグの (href, テキスト) のリスト
+        ツリーは作らず、iterparse で a タグだけを読む
+        """
+        anchors = []  # type: List[Tuple[Optional[str], str]]
+        for _event, a in ElementTree.iterparse(
+            xml_file, tag=(XHTML_A_TAG, 'a'), **options
+        ):
+            anchors.append((a.attrib.get('href'), ''.join(a.itertext())))
+            a.clear()
+        return anchors
 
     @cached_property
     def navigation_xml_data(self):
         def _gen():
-            bs = self.navigation_xml_bs4
-            for a in bs.find_all('a'):
-                href = a['href']
+            for href, text in self.ee.read_xml(
+                self.navigation_xml_path, self._read_anchors
+            ):
+                if not href:
+                    continue
                 page_number = self.ee.get_page_number_from_page_xml_path(href)
-                yield OrderedDict(
-                    [
-                        ('page_xml', href),
-                        ('start_page', page_number),
-                        ('section_title', a.text),
-                    ]
-                )
+                yield {
+                    'page_xml': href,
+                    'start_page': page_number,
+                    'section_title': text,
+                }
 
         return list(_gen())
 
     @cached_property
     def cleaned_navigation_xml_data(self):
-        attended = set()
-        navs = []
-        for o in sorted(
-            self.navigation_xml_data, key=lambda x: x['start_page']
-        ):
-            if o['start_page'] in attended:
-                continue
-            attended.add(o['start_page'])
-            if navs:
-                navs[-1]['end_page'] = o['start_page'] - 1
-            navs.append(o)
-        if navs:
-            navs[-1]['end_page'] = self.ee.last_page_number
-        return navs
+        return clean_toc_data(
+            self.navigation_xml_data, self.ee.last_page_number
+        )
 
     def debug_cleaned_navigation_xml_data(self):
         for o in self.cleaned_navigation_xml_data:
@@ -830,64 +1080,64 @@ class TocNcx:
     def __init__(self, epub_extractor):
         self.ee = epub_extractor
 
-    @cached_property
-    def toc_ncx_etree(self) -> ElementTree:
-        return parse_xml_with_recover(self.toc_ncx_path)
-
     @cached_property
     def toc_ncx_path(self) -> str:
-        manifest = self.ee.content_xml_etree.find(
-            './/{http://www.idpf.org/2007/opf}manifest'
-        )
-        items = manifest.findall('.//{http://www.idpf.org/2007/opf}item')
-        for item in items:
-            if (
-                item.attrib.get('media-type') == 'application/x-dtbncx+xml'
-                or item.attrib.get('id') == 'ncx'
-            ):
-                return os.path.join(
-                    self.ee.content_base_dir, item.attrib.get('href')
-                )
-        raise self.TocNcxNotFound()
+        item = self.ee.content_xml_elements.ncx_item
+        if item is None:
+            raise self.TocNcxNotFound()
+        return self.ee.get_content_path(item.attrib.get('href'))
+
+    def _read_nav_points(
+        self, xml_file: IO[bytes], **options
+    ) -> List[Tuple[Optional[str], Optional[str]]]:
+        """
+        navPoint の (content の src, 見出し) を文書順に並べたリスト
+        ツリー全体は作らず、iterparse で navPoint ごとに読んで解放する
+        """
+        nav_points = []  # type: List[Tuple[Optional[str], Optional[str]]]
+        # 入れ子の navPoint は親より先に終わるので、開始時に親の場所を確保しておく
+        slots = []  # type: List[int]
+        for event, np in ElementTree.iterparse(
+            xml_file, events=('start', 'end'), tag='{*}navPoint', **options
+        ):
+            if event == 'start':
+                slots.append(len(nav_points))
+                nav_points.append((None, None))
+                continue
+            content = np.find('{*}content')
+            nav_points[slots.pop()] = (
+                content.attrib.get('src') if content is not None else None,
+                np.findtext('{*}navLabel/{*}text'),
+            )
+            # 親の navLabel, content は子の navPoint より前にあるので、
+            # 解放するのはこの navPoint だけにする
+            np.clear()
+        return nav_points
 
     @cached_property
-    def toc_ncx_data(self) -> List[OrderedDict]:
+    def toc_ncx_data(self) -> List[Dict[str, Any]]:
         """
         toc.ncx を解析した辞書
         """
 
         def _gen():
-            ntq = namespace_tag_query(self.toc_ncx_etree._root)
-            for np in self.toc_ncx_etree.findall(ntq('navPoint')):
-                text = np.find(ntq('text'))
-                content = np.find(ntq('content'))
-                src = content.attrib.get('src')
+            for src, text in self.ee.read_xml(
+                self.toc_ncx_path, self._read_nav_points
+            ):
+                if not src:
+                    continue
                 page_number = self.ee.get_page_number_from_page_xml_path(src)
-                # play_order = np.attrib.get('playOrder')
-                yield OrderedDict(
-                    [
-                        ('page_xml', src),
-                        ('start_page', page_number),
-                        ('section_title', text.text),
-                    ]
-                )
+                yield {
+                    'page_xml': src,
+                    'start_page': page_number,
+                    'section_title': text,
+                }
 
         return list(_gen())
 
     @cached_property
     def cleaned_toc_ncx_data(self):
-        attended = set()
-        navs = []
-        for o in sorted(self.toc_ncx_data, key=lambda x: x['start_page']):
-            if o['start_page'] in attended:
-                continue
-            attended.add(o['start_page'])
-            if navs:
-                navs[-1]['end_page'] = o['start_page'] - 1
-            navs.append(o)
-        if navs:
-            navs[-1]['end_page'] = self.ee.last_page_number
-        return navs
+        return clean_toc_data(self.toc_ncx_data, self.ee.last_page_number)
 
     def debug_cleaned_toc_ncx_data(self) -> None:
         for o in self.cleaned_toc_ncx_data:
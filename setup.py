@@ -13,7 +13,8 @@ setup(
     url='https://github.com/ytyng/epub-extractor.git',
     keywords='comic epub extract jpeg images and meta information.',
     packages=['epub_extractor'],
-    install_requires=[],
+    python_requires='>=3.8',
+    install_requires=['lxml'],
     entry_points={
         'console_scripts': [
             'epub-extract-jpeg = epub_extractor.epub_extract_jpeg:main',
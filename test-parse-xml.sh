@@ -0,0 +1,71 @@
+#!/bin/bash
+
+# parse_xml_with_recover と、目次の読み込みで、
+# 正しい XML をそのまま読めることと、& の使い方が悪い XML を修復できることを確認する
+
+cd $(dirname $0)
+
+python3 - <<'EOF'
+import io
+import os
+import tempfile
+import zipfile
+
+from epub_extractor.epub_extractor import EpubExtractor, parse_xml_with_recover
+
+
+def parse_text(xml_source):
+    return parse_xml_with_recover(io.BytesIO(xml_source)).getroot().text
+
+
+# 正しい XML は修復しない
+utf16 = '<?xml version="1.0" encoding="UTF-16"?><t>A &amp; B</t>'
+assert parse_text(utf16.encode('utf-16')) == 'A & B'
+assert parse_text(b'<t><![CDATA[Q&A]]></t>') == 'Q&A'
+root = parse_xml_with_recover(io.BytesIO(b'<t><!-- Q&A --></t>')).getroot()
+assert root[0].text == ' Q&A '
+
+# & の使い方が悪い XML は、& を残して修復する
+title = 'タイトル & co'
+assert parse_text('<t>{}</t>'.format(title).encode('utf-8')) == title
+broken_utf16 = '<?xml version="1.0" encoding="UTF-16"?><t>A & B &amp; C</t>'
+assert parse_text(broken_utf16.encode('utf-16')) == 'A & B & C'
+root = parse_xml_with_recover(
+    io.BytesIO(b'<r><t>A & B</t><u><![CDATA[Q&A]]></u></r>')
+).getroot()
+assert [e.text for e in root] == ['A & B', 'Q&A']
+
+# toc.ncx の見出しも同様
+container_xml = '''<?xml version="1.0"?>
+<container xmlns="urn:oasis:names:tc:opendocument:xmlns:container" version="1.0">
+<rootfiles><rootfile full-path="item/standard.opf"
+media-type="application/oebps-package+xml"/></rootfiles></container>'''
+content_xml = '''<?xml version="1.0" encoding="UTF-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0">
+<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+<dc:title>{}</dc:title></metadata>
+<manifest>
+<item id="p1" href="xhtml/p-001.xhtml" media-type="application/xhtml+xml"/>
+<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>
+</manifest>
+<spine><itemref idref="p1"/></spine></package>'''.format(title)
+toc_ncx = '''<?xml version="1.0" encoding="UTF-8"?>
+<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1"><navMap>
+<navPoint id="n1"><navLabel><text>{}</text></navLabel>
+<content src="xhtml/p-001.xhtml"/></navPoint></navMap></ncx>'''.format(title)
+
+with tempfile.TemporaryDirectory() as temp_dir:
+    epub_path = os.path.join(temp_dir, 'test.epub')
+    with zipfile.ZipFile(epub_path, 'w') as z:
+        z.writestr('mimetype', 'application/epub+zip')
+        z.writestr('META-INF/container.xml', container_xml)
+        z.writestr('item/standard.opf', content_xml)
+        z.writestr('item/toc.ncx', toc_ncx)
+    epub_extractor = EpubExtractor(epub_path)
+    assert epub_extractor.meta.title == title
+    toc = epub_extractor.get_toc_table()
+    assert [o['section_title'] for o in toc] == [title], toc
+    epub_extractor.close()
+
+print('OK')
+EOF